@@ -5,9 +5,17 @@ import sqlite3
 import math
 import json
 import uuid
+import os
+import threading
+import atexit
+import queue
+from concurrent.futures import Future
+import asyncio
 from contextvars import ContextVar
 
-from fastapi import FastAPI, HTTPException, Request
+import numpy as np
+import anyio
+from fastapi import FastAPI, HTTPException, Request, Body
 from fastapi.responses import JSONResponse
 
 # CONFIG
@@ -26,6 +34,26 @@ class SimpleJsonFormatter(logging.Formatter):
         return json.dumps(log_data)
 
 DB_PATH = "./demo.db"
+# Number of uvicorn worker processes when run directly
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Set RANDOM_SEED to make the simulated failures reproducible between runs
+RANDOM_SEED = os.getenv("RANDOM_SEED")
+if RANDOM_SEED is not None:
+    random.seed(RANDOM_SEED)
+# WAL journal with NORMAL sync avoids an fsync per commit
+DB_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "cache_size=-65536",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+)
+# Inserts queued while a commit runs share the next one, up to DB_BATCH_SIZE requests
+DB_BATCH_SIZE = 500
+# Largest list accepted by /process_transactions_batch, one request can't hold the writer for long
+MAX_BATCH_TRANSACTIONS = DB_BATCH_SIZE
+# Longest a request waits for its insert to be committed
+DB_WRITE_TIMEOUT_S = 5
 
 LOG_FILE = "/var/log/elk_app/elk_app.log"
 
@@ -47,7 +75,7 @@ async def log_requests(request: Request, call_next):
     request_id_var.set(req_id)
     
     start = time.time()
-    logger.info(f"Request to {request.url.path}")
+    logger.info("Request to %s", request.url.path)
     
     try:
         response = await call_next(request)
@@ -57,19 +85,127 @@ async def log_requests(request: Request, call_next):
         return response
     except Exception as e:
         ms = round((time.time() - start) * 1000, 2)
-        logger.error(f"Request failed: {str(e)}", extra={"extra_info": {"ms": ms}})
+        logger.error("Request failed: %s", e, extra={"extra_info": {"ms": ms}})
         return JSONResponse(status_code=500, content={"detail": "Server Error"})
 
-# Returns or creates database
-def get_db():
+# Database connections are pooled per thread, sqlite3 connections can't be shared
+_db_local = threading.local()
+_db_conns = []
+_db_lock = threading.Lock()
+
+# Creates the schema once at startup, keeping DDL off the request path
+def init_db():
     conn = sqlite3.connect(DB_PATH)
     conn.execute("CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY, amount REAL, status TEXT)")
+    conn.close()
+
+# Returns the calling thread's connection
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        # check_same_thread is off only so the exit hook can close it
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}")
+        with _db_lock:
+            _db_conns.append(conn)
+        _db_local.conn = conn
     return conn
 
+@atexit.register
+def close_db():
+    with _db_lock:
+        for conn in _db_conns:
+            conn.close()
+        _db_conns.clear()
+
+# Writes go through a single writer thread so concurrent requests share commits
+_db_queue = queue.Queue()
+
+# Statements are built once, sqlite3's per-connection cache then reuses the parsed plan
+INSERT_SQL = {
+    table: f"INSERT INTO {table} (amount, status) VALUES (?, ?)"
+    for table in ("transactions", "fake_db")
+}
+
+# Queues rows for insertion, the returned Future resolves once they are committed
+def enqueue_insert(table, rows):
+    future = Future()
+    _db_queue.put((table, rows, future))
+    return future
+
+def _fail(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+def _write_batch(batch):
+    # Requests cancelled while queued are dropped, the rest can no longer be cancelled
+    batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+    if not batch:
+        return
+
+    conn = None
+    try:
+        conn = get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        for table, rows, future in batch:
+            # A savepoint per request keeps a failed insert's partial rows out of the commit
+            conn.execute("SAVEPOINT request_insert")
+            try:
+                conn.executemany(INSERT_SQL[table], rows)
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO request_insert")
+                _fail(future, e)
+            conn.execute("RELEASE request_insert")
+        conn.commit()
+    except Exception as e:
+        if conn is not None:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+        for _, _, future in batch:
+            _fail(future, e)
+        return
+
+    for _, _, future in batch:
+        if not future.done():
+            future.set_result(None)
+
+def _db_writer():
+    while True:
+        batch = [_db_queue.get()]
+        # Takes whatever queued up during the previous commit, never waits for more
+        while len(batch) < DB_BATCH_SIZE:
+            try:
+                batch.append(_db_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_batch(batch)
+        except Exception as e:
+            # Keep the writer alive, an exit here would leave every later request waiting
+            for _, _, future in batch:
+                _fail(future, e)
+
+_db_writer_started = False
+
+# Started from the startup hook so only serving processes run a writer
+def start_db_writer():
+    global _db_writer_started
+    if not _db_writer_started:
+        threading.Thread(target=_db_writer, name="db-writer", daemon=True).start()
+        _db_writer_started = True
+
+@app.on_event("startup")
+def startup():
+    init_db()
+    start_db_writer()
+
 # Simulates business transaction.
 # Contains configurable fail rate to simulate app failure spikes
 @app.get("/process_transaction")
-def process_transaction(total: int, fail_rate: float = 0.3, mult: int = 5):
+async def process_transaction(total: int, fail_rate: float = 0.3, mult: int = 5):
     logger.info("Starting transaction", extra={"extra_info": {"total": total}})
     
     # Simulates processing
@@ -77,7 +213,7 @@ def process_transaction(total: int, fail_rate: float = 0.3, mult: int = 5):
     """val = 0
     for i in range(500_000):
         val += math.sqrt(i)"""
-    ret = maintenance_task(mult)
+    ret = await maintenance_task(mult)
     
     logger.info("CPU loop done", 
                 extra=  {"extra_info": 
@@ -95,34 +231,65 @@ def process_transaction(total: int, fail_rate: float = 0.3, mult: int = 5):
     # Database record insert
     db_start = time.time()
     try:
-        conn = get_db()
-        cur = conn.cursor()
-        
         table = "fake_db" if random.random() < fail_rate else "transactions"
-        cur.execute(f"INSERT INTO {table} (amount, status) VALUES (?, ?)", (total, "SUCCESS"))
-        conn.commit()
-        conn.close()
+        future = enqueue_insert(table, [(total, "SUCCESS")])
+        await asyncio.wait_for(asyncio.wrap_future(future), DB_WRITE_TIMEOUT_S)
         
         logger.info("DB insert OK", extra={"extra_info": {"db_ms": round((time.time() - db_start) * 1000, 2), "table": table}})
             
     except Exception as e:
-        logger.error(f"DB error: {str(e)}", extra={"extra_info": {"db_ms": round((time.time() - db_start) * 1000, 2)}})
+        logger.error("DB error: %s", e, extra={"extra_info": {"db_ms": round((time.time() - db_start) * 1000, 2)}})
         raise HTTPException(status_code=500, detail="DB error")
 
     return {"status": "processed", "req_id": request_id_var.get()}
 
+# Simulates a bulk submission, all rows are inserted and committed together
+@app.post("/process_transactions_batch")
+async def process_transactions_batch(totals: list[int] = Body(..., max_length=MAX_BATCH_TRANSACTIONS),
+                                     fail_rate: float = 0.3):
+    logger.info("Starting batch", extra={"extra_info": {"count": len(totals)}})
+
+    # Processing failure simulation
+    if random.random() < fail_rate:
+        logger.warning("Fraud check failed")
+        raise HTTPException(status_code=400, detail="Fraud rejected")
+
+    # Database records insert
+    db_start = time.time()
+    try:
+        table = "fake_db" if random.random() < fail_rate else "transactions"
+        future = enqueue_insert(table, [(total, "SUCCESS") for total in totals])
+        await asyncio.wait_for(asyncio.wrap_future(future), DB_WRITE_TIMEOUT_S)
+
+        logger.info("DB batch insert OK", extra={"extra_info": {"db_ms": round((time.time() - db_start) * 1000, 2), "table": table, "count": len(totals)}})
+
+    except Exception as e:
+        logger.error("DB error: %s", e, extra={"extra_info": {"db_ms": round((time.time() - db_start) * 1000, 2)}})
+        raise HTTPException(status_code=500, detail="DB error")
+
+    return {"status": "processed", "count": len(totals), "req_id": request_id_var.get()}
+
+# Sorts n random floats, run off the event loop.
+# Kept single threaded on purpose, the sort only exists to generate CPU load
+def _sort_random(n):
+    data = np.random.default_rng().random(n)
+    data.sort()
+
 # Function to cause CPU high load
 @app.get("/maintenance")
-def maintenance_task(mult: int = 5):
+async def maintenance_task(mult: int = 5):
     logger.info("Starting maintenance")
     start = time.time()
     
-    data = [random.random() for _ in range(mult * 100_000)]
-    data.sort()
+    await anyio.to_thread.run_sync(_sort_random, mult * 100_000)
     
     logger.info("Maintenance done", extra={"extra_info": {"ms": round((time.time() - start) * 1000, 2)}})
     return {"status": "done", "req_id": request_id_var.get()}
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
+    # An import string is only needed to spawn workers, it imports the module a second time
+    if WORKERS > 1:
+        uvicorn.run("elk_app_trad:app", host="0.0.0.0", port=8080, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
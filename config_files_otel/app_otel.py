@@ -5,12 +5,24 @@ import sqlite3
 import math
 import json
 import uuid
+import threading
+import atexit
+import queue
+from concurrent.futures import Future
+import os
+import asyncio
+import warnings
 from contextvars import ContextVar
 
-from fastapi import FastAPI, HTTPException, Request
+import numpy as np
+import anyio
+from fastapi import FastAPI, HTTPException, Request, Query, Body
 from fastapi.responses import JSONResponse
 
+from google.protobuf.internal import api_implementation
 from opentelemetry import  _logs, metrics, trace
+from opentelemetry._logs import LogRecord, SeverityNumber
+from opentelemetry.context import get_current
 from opentelemetry.sdk.resources import Resource
 # Logging libraries
 from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
@@ -31,40 +43,76 @@ from opentelemetry.instrumentation.fastapi import FastAPIInstrumentor
 from opentelemetry.instrumentation.sqlite3 import SQLite3Instrumentor
 from opentelemetry.instrumentation.system_metrics import SystemMetricsInstrumentor
 
+# Numba is optional, NumPy is used for the processing simulation without it
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 # CONFIG
 DB_PATH = "./demo.db"
+# Number of uvicorn worker processes when run directly
+WORKERS = int(os.getenv("WORKERS", "1"))
+# Set RANDOM_SEED to make the simulated failures reproducible between runs
+RANDOM_SEED = os.getenv("RANDOM_SEED")
+if RANDOM_SEED is not None:
+    random.seed(RANDOM_SEED)
+# WAL journal with NORMAL sync avoids an fsync per commit
+DB_PRAGMAS = (
+    "journal_mode=WAL",
+    "synchronous=NORMAL",
+    "cache_size=-65536",
+    "temp_store=MEMORY",
+    "mmap_size=268435456",
+)
+# Inserts queued while a commit runs share the next one, up to DB_BATCH_SIZE requests
+DB_BATCH_SIZE = 500
+# Largest list accepted by /process_transactions_batch, one request can't hold the writer for long
+MAX_BATCH_TRANSACTIONS = DB_BATCH_SIZE
+# Longest a request waits for its insert to be committed
+DB_WRITE_TIMEOUT_S = 5
+PROCESSING_ITERATIONS = 500_000
+# Set SIMULATE_CPU=0 to skip the simulated processing step entirely
+SIMULATE_CPU = os.getenv("SIMULATE_CPU", "1") == "1"
+# Upper bound for burn_ms, each burn holds a worker thread and a core for its duration
+MAX_BURN_MS = 10_000
 
 OTEL_ENDPOINT = "http://localhost:4317"
+# gRPC channel options shared by the trace, metric and log exporters. Keepalive
+# pings detect dead collector connections; 5 min matches the collector's default
+# minimum ping interval so it doesn't close the channel for pinging too often.
+# Compression is left to OTEL_EXPORTER_OTLP_COMPRESSION.
+OTEL_CHANNEL_OPTIONS = (
+    ("grpc.keepalive_time_ms", 300_000),
+    ("grpc.keepalive_timeout_ms", 20_000),
+    ("grpc.http2.max_pings_without_data", 0),
+)
 SERVICE_NAME = "app-otel"
-resource = Resource.create({"service.name": SERVICE_NAME})
+# Per-statement sqlite3 spans are opt-in, the database_insert_simulation span covers the insert
+INSTRUMENT_SQLITE = os.getenv("INSTRUMENT_SQLITE", "0") == "1"
+# Larger, more frequent export batches amortise the gRPC round trips
+BATCH_PROCESSOR_OPTIONS = {
+    "max_queue_size": 16384,
+    "max_export_batch_size": 2048,
+    "schedule_delay_millis": 1000,
+}
+# Each worker process reports as its own instance, so their cumulative series don't collide
+resource = Resource.create({
+    "service.name": SERVICE_NAME,
+    "service.instance.id": str(uuid.uuid4()),
+})
 
-# Logs Setup
-logger_provider = LoggerProvider(resource=resource)
-_logs.set_logger_provider(logger_provider)
-log_exporter = OTLPLogExporter(endpoint=OTEL_ENDPOINT, insecure=True)
-logger_provider.add_log_record_processor(BatchLogRecordProcessor(log_exporter))
+# Providers are created by _init_otel() on startup, so each worker sets up its
+# own exporters after fork. Until then the API hands out proxy tracers/meters.
+logger_provider = None
+meter_provider = None
+trace_provider = None
+_otel_ready = False
 
-handler = LoggingHandler(level=logging.INFO, logger_provider=logger_provider)
-logging.getLogger().addHandler(handler)
-logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
-
-
-# Metrics Setup
-delta_temporality = {
-    Histogram: AggregationTemporality.DELTA
-}
-metric_reader = PeriodicExportingMetricReader(
-    OTLPMetricExporter(
-                        endpoint=OTEL_ENDPOINT, 
-                        insecure=True, 
-                        preferred_temporality=delta_temporality
-                    ),
-    export_interval_millis=5000, 
-)
-meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
-metrics.set_meter_provider(meter_provider)
+otel_logger = _logs.get_logger(__name__)
 meter = metrics.get_meter(__name__)
+tracer = trace.get_tracer(__name__)
 
 # Metrics Definition
 database_error_counter = meter.create_counter(
@@ -85,63 +133,265 @@ processing_duration = meter.create_histogram(
     description="Time taken for heavy processing tasks"
 )
 
-# Traces Setup
-trace_provider = TracerProvider(resource=resource)
-span_processor = BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_ENDPOINT, insecure=True))
-trace_provider.add_span_processor(span_processor)
-trace.set_tracer_provider(trace_provider)
-tracer = trace.get_tracer(__name__)
+# Emits INFO logs straight to OTel, skipping the stdlib logging handler chain.
+# Honours logger's configured level and, like logging, formats msg % args only
+# when the record is emitted. Warnings and errors still go through logger.
+def log_info(msg, *args):
+    if not logger.isEnabledFor(logging.INFO):
+        return
+    body = str(msg)
+    if args:
+        # Like logging, a bad format string must never fail the request itself
+        try:
+            body = body % args
+        except (TypeError, ValueError):
+            body = f"{body} {args!r}"
+    now = time.time_ns()
+    # The current context carries the active span, linking the log to its trace
+    otel_logger.emit(LogRecord(
+        timestamp=now,
+        observed_timestamp=now,
+        context=get_current(),
+        severity_text="INFO",
+        severity_number=SeverityNumber.INFO,
+        body=body,
+    ))
+
+def _init_otel():
+    global logger_provider, meter_provider, trace_provider, _otel_ready
+    if _otel_ready:
+        return
+
+    # Logs Setup
+    logger_provider = LoggerProvider(resource=resource)
+    _logs.set_logger_provider(logger_provider)
+    log_exporter = OTLPLogExporter(endpoint=OTEL_ENDPOINT, insecure=True, channel_options=OTEL_CHANNEL_OPTIONS)
+    logger_provider.add_log_record_processor(BatchLogRecordProcessor(log_exporter, **BATCH_PROCESSOR_OPTIONS))
+
+    handler = LoggingHandler(level=logging.INFO, logger_provider=logger_provider)
+    logging.getLogger().addHandler(handler)
+    logging.getLogger().setLevel(logging.INFO)
+
+    # OTLP payloads are encoded with protobuf, the pure-Python backend is much slower
+    # warnings.warn reaches stderr, the root logger only ships to the OTel backend
+    if api_implementation.Type() == "python":
+        message = ("protobuf is using its pure-Python backend, unset "
+                   "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION or install the binary wheel")
+        warnings.warn(message, RuntimeWarning)
+        logger.warning(message)
+
+    # Metrics Setup
+    delta_temporality = {
+        Histogram: AggregationTemporality.DELTA
+    }
+    metric_reader = PeriodicExportingMetricReader(
+        OTLPMetricExporter(
+                            endpoint=OTEL_ENDPOINT, 
+                            insecure=True, 
+                            channel_options=OTEL_CHANNEL_OPTIONS,
+                            preferred_temporality=delta_temporality
+                        ),
+        export_interval_millis=5000, 
+    )
+    meter_provider = MeterProvider(resource=resource, metric_readers=[metric_reader])
+    metrics.set_meter_provider(meter_provider)
+
+    # Traces Setup
+    trace_provider = TracerProvider(resource=resource)
+    span_processor = BatchSpanProcessor(OTLPSpanExporter(endpoint=OTEL_ENDPOINT, insecure=True, channel_options=OTEL_CHANNEL_OPTIONS), **BATCH_PROCESSOR_OPTIONS)
+    trace_provider.add_span_processor(span_processor)
+    trace.set_tracer_provider(trace_provider)
+
+    if INSTRUMENT_SQLITE:
+        SQLite3Instrumentor().instrument()
+    SystemMetricsInstrumentor().instrument()
+    _otel_ready = True
 
 # App setup
 app = FastAPI()
+# Middleware must be added before the app starts, it resolves the provider lazily
 FastAPIInstrumentor.instrument_app(app)
-SQLite3Instrumentor().instrument()
-SystemMetricsInstrumentor().instrument()
+
+@app.on_event("startup")
+def startup():
+    _init_otel()
+    init_db()
+    start_db_writer()
 
 # Logs every request, saving path and execution time
 @app.middleware("http")
 async def log_requests(request: Request, call_next):
     with tracer.start_as_current_span("entry_function") as span:
         start = time.time()
-        logger.info(f"Request to {request.url.path}")
+        log_info("Request to %s", request.url.path)
         
         try:
             response = await call_next(request)
             ms = round((time.time() - start) * 1000, 2)
-            logger.info("Request OK")
+            log_info("Request OK")
             span.set_attribute("request_result", "Success")
             return response
         except Exception as e:
             ms = round((time.time() - start) * 1000, 2)
-            logger.exception(f"Request failed: {str(e)}")
+            logger.exception("Request failed: %s", e)
             span.set_attribute("request_result", "Failed")
             return JSONResponse(status_code=500, content={"detail": "Server Error"})
 
-# Returns or creates database
-def get_db():
+# Database connections are pooled per thread, sqlite3 connections can't be shared
+_db_local = threading.local()
+_db_conns = []
+_db_lock = threading.Lock()
+
+# Creates the schema once at startup, keeping DDL off the request path
+def init_db():
     conn = sqlite3.connect(DB_PATH)
     conn.execute("CREATE TABLE IF NOT EXISTS transactions (id INTEGER PRIMARY KEY, amount REAL, status TEXT)")
+    conn.close()
+
+# Returns the calling thread's connection
+def get_db():
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        # check_same_thread is off only so the exit hook can close it
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+        for pragma in DB_PRAGMAS:
+            conn.execute(f"PRAGMA {pragma}")
+        with _db_lock:
+            _db_conns.append(conn)
+        _db_local.conn = conn
     return conn
 
+@atexit.register
+def close_db():
+    with _db_lock:
+        for conn in _db_conns:
+            conn.close()
+        _db_conns.clear()
+
+# Writes go through a single writer thread so concurrent requests share commits
+_db_queue = queue.Queue()
+
+# Statements are built once, sqlite3's per-connection cache then reuses the parsed plan
+INSERT_SQL = {
+    table: f"INSERT INTO {table} (amount, status) VALUES (?, ?)"
+    for table in ("transactions", "fake_db")
+}
+
+# Queues rows for insertion, the returned Future resolves once they are committed
+def enqueue_insert(table, rows):
+    future = Future()
+    _db_queue.put((table, rows, future))
+    return future
+
+def _fail(future, e):
+    if not future.done():
+        future.set_exception(e)
+
+def _write_batch(batch):
+    # Requests cancelled while queued are dropped, the rest can no longer be cancelled
+    batch = [item for item in batch if item[2].set_running_or_notify_cancel()]
+    if not batch:
+        return
+
+    conn = None
+    try:
+        conn = get_db()
+        conn.execute("BEGIN IMMEDIATE")
+        for table, rows, future in batch:
+            # A savepoint per request keeps a failed insert's partial rows out of the commit
+            conn.execute("SAVEPOINT request_insert")
+            try:
+                conn.executemany(INSERT_SQL[table], rows)
+            except sqlite3.Error as e:
+                conn.execute("ROLLBACK TO request_insert")
+                _fail(future, e)
+            conn.execute("RELEASE request_insert")
+        conn.commit()
+    except Exception as e:
+        if conn is not None:
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+        for _, _, future in batch:
+            _fail(future, e)
+        return
+
+    for _, _, future in batch:
+        if not future.done():
+            future.set_result(None)
+
+def _db_writer():
+    while True:
+        batch = [_db_queue.get()]
+        # Takes whatever queued up during the previous commit, never waits for more
+        while len(batch) < DB_BATCH_SIZE:
+            try:
+                batch.append(_db_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _write_batch(batch)
+        except Exception as e:
+            # Keep the writer alive, an exit here would leave every later request waiting
+            for _, _, future in batch:
+                _fail(future, e)
+
+_db_writer_started = False
+
+# Started from the startup hook so only serving processes run a writer
+def start_db_writer():
+    global _db_writer_started
+    if not _db_writer_started:
+        threading.Thread(target=_db_writer, name="db-writer", daemon=True).start()
+        _db_writer_started = True
+
+# Simulated processing kernel, compiled to native code by Numba.
+# The explicit signature compiles it eagerly at import (or loads it from the
+# on-disk cache), so neither the first request nor dispatch pays for typing.
+# nogil lets the event loop keep running while a worker thread executes it.
+if njit is not None:
+    @njit("float64(int64)", cache=True, fastmath=True, nogil=True)
+    def _processing_sum(n):
+        val = 0.0
+        for i in range(n):
+            val += math.sqrt(i)
+        return val
+else:
+    # Index buffer allocated once and reused by every request
+    _PROCESSING_IDX = np.arange(PROCESSING_ITERATIONS, dtype=np.float64)
+
+    def _processing_sum(n):
+        return float(np.sqrt(_PROCESSING_IDX[:n]).sum())
+
+# Spins for a fixed wall time, independent of hardware speed
+def _burn_cpu(ms):
+    deadline = time.monotonic() + ms / 1000
+    while time.monotonic() < deadline:
+        pass
+
 # Simulates business transaction.
 # Contains configurable fail rate to simulate app failure spikes
 @app.get("/process_transaction")
-def process_transaction(total: int, fail_rate: float = 0.3):
+async def process_transaction(total: int, fail_rate: float = 0.3,
+                              burn_ms: float = Query(0, ge=0, le=MAX_BURN_MS, allow_inf_nan=False)):
     with tracer.start_as_current_span("process_transaction") as span:
 
-        logger.info("Starting transaction")
-        
-        with tracer.start_as_current_span("processing_simultaion") as span1:
-            # Simulates processing
-            cpu_start = time.time()
-            val = 0
-            for i in range(500_000):
-                val += math.sqrt(i)
+        log_info("Starting transaction")
         
-            total_time = time.time() - cpu_start
-            processing_duration.record(total_time)
-            logger.info("CPU loop done")
-            span1.set_attribute("processing_time", total_time)
+        if SIMULATE_CPU:
+            with tracer.start_as_current_span("processing_simultaion") as span1:
+                # Simulates processing, either for burn_ms or a fixed workload
+                cpu_start = time.time()
+                if burn_ms > 0:
+                    await anyio.to_thread.run_sync(_burn_cpu, burn_ms)
+                else:
+                    await anyio.to_thread.run_sync(_processing_sum, PROCESSING_ITERATIONS)
+
+                total_time = time.time() - cpu_start
+                processing_duration.record(total_time)
+                log_info("CPU loop done")
+                span1.set_attribute("processing_time", total_time)
 
         with tracer.start_as_current_span("fraud_check_simulation") as span1:
             # Processing failure simulation
@@ -156,44 +406,86 @@ def process_transaction(total: int, fail_rate: float = 0.3):
             # Database record insert
             db_start = time.time()
             try:
-                conn = get_db()
-                cur = conn.cursor()
-                
                 table = "fake_db" if random.random() < fail_rate else "transactions"
-                cur.execute(f"INSERT INTO {table} (amount, status) VALUES (?, ?)", (total, "SUCCESS"))
-                conn.commit()
-                conn.close()
+                future = enqueue_insert(table, [(total, "SUCCESS")])
+                await asyncio.wait_for(asyncio.wrap_future(future), DB_WRITE_TIMEOUT_S)
                 
                 transaction_amount_sum.add(total)
                 span1.set_attribute("database_insert_result", "Success")
-                logger.info("DB insert OK")
+                log_info("DB insert OK")
                     
             except Exception as e:
                 database_error_counter.add(1)
-                logger.exception(f"DB error: {str(e)}")
+                logger.exception("DB error: %s", e)
                 span1.set_attribute("database_insert_result", "Failed")
                 raise HTTPException(status_code=500, detail="DB error")
 
         span.set_attribute("transacted_amount", total)
         return {"status": "processed"}
 
+# Simulates a bulk submission, all rows are inserted and committed together
+@app.post("/process_transactions_batch")
+async def process_transactions_batch(totals: list[int] = Body(..., max_length=MAX_BATCH_TRANSACTIONS),
+                                     fail_rate: float = 0.3):
+    with tracer.start_as_current_span("process_transactions_batch") as span:
+
+        log_info("Starting batch of %s transactions", len(totals))
+
+        with tracer.start_as_current_span("fraud_check_simulation") as span1:
+            # Processing failure simulation
+            if random.random() < fail_rate:
+                logger.warning("Fraud check failed")
+                span1.set_attribute("fraud_check_result", "Failed")
+                raise HTTPException(status_code=400, detail="Fraud rejected")
+            else:
+                span1.set_attribute("fraud_check_result", "Success")
+
+        with tracer.start_as_current_span("database_insert_simulation") as span1:
+            # Database records insert
+            try:
+                table = "fake_db" if random.random() < fail_rate else "transactions"
+                future = enqueue_insert(table, [(total, "SUCCESS") for total in totals])
+                await asyncio.wait_for(asyncio.wrap_future(future), DB_WRITE_TIMEOUT_S)
+
+                transaction_amount_sum.add(sum(totals))
+                span1.set_attribute("database_insert_result", "Success")
+                log_info("DB batch insert OK")
+
+            except Exception as e:
+                database_error_counter.add(1)
+                logger.exception("DB error: %s", e)
+                span1.set_attribute("database_insert_result", "Failed")
+                raise HTTPException(status_code=500, detail="DB error")
+
+        span.set_attributes({"transaction_count": len(totals), "transacted_amount": sum(totals)})
+        return {"status": "processed", "count": len(totals)}
+
+# Sorts n random floats, run off the event loop.
+# Kept single threaded on purpose, the sort only exists to generate CPU load
+def _sort_random(n):
+    data = np.random.default_rng().random(n)
+    data.sort()
+
 # Function to cause CPU high load
 @app.get("/maintenance")
-def maintenance_task(mult: int = 5):
+async def maintenance_task(mult: int = 5):
     with tracer.start_as_current_span("database_insert_simulation") as span:
-        logger.info("Starting maintenance")
+        log_info("Starting maintenance")
         start = time.time()
         
-        data = [random.random() for _ in range(mult * 100_000)]
-        data.sort()
+        await anyio.to_thread.run_sync(_sort_random, mult * 100_000)
         
         total_time = time.time() - start
         processing_duration.record(total_time)
-        logger.info("Maintenance done.")
+        log_info("Maintenance done.")
         span.set_attribute("processing_time", total_time)
         return {"status": "done"}
 
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8080)
+    # An import string is only needed to spawn workers, it imports the module a second time
+    if WORKERS > 1:
+        uvicorn.run("app_otel:app", host="0.0.0.0", port=8080, workers=WORKERS)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8080)